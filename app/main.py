@@ -1,15 +1,21 @@
 # app/main.py
 import os
+import errno
+import time
+import re
 import uuid
 import zipfile
 import shutil
 import tempfile
 import subprocess
 import asyncio
-from typing import Optional, List
+import functools
+import hashlib
+import contextlib
+from typing import Optional, List, Dict, Tuple
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Header, Query
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from starlette.background import BackgroundTask
 import asyncpg
 import logging
@@ -21,10 +27,61 @@ DB_DSN = os.getenv("DATABASE_DSN")
 if not DB_DSN:
     raise RuntimeError("Environment variable DATABASE_DSN belum diset. Isi connection string Supabase Anda.")
 
+# cache prepared statement asyncpg per koneksi; set 0 jika lewat pooler mode
+# transaction (mis. Supabase port 6543) yang tidak mendukung prepared statement
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "200"))
+# DB_JIT_OFF=1 mengirim jit=off sebagai startup parameter tiap koneksi. Pooler
+# PgBouncer/transaction mode umumnya menolak parameter ini; di sana gunakan
+# ALTER ROLE <user> SET jit = off; di database.
+DB_JIT_OFF = os.getenv("DB_JIT_OFF", "").lower() in ("1", "true", "yes")
+
 TARGET_TABLE = os.getenv("TARGET_TABLE", "public.tapak_proyek")
+# prefix staging: tiap upload memakai tabel sendiri '<STAGING_TABLE>_<hex>' agar upload
+# bersamaan (antar worker uvicorn) tidak saling menimpa isi staging
 STAGING_TABLE = os.getenv("STAGING_TABLE", "public.staging_tapak_upload")
 MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))  # default 50MB
+UPLOAD_CHUNK_BYTES = 1024 * 1024  # ukuran chunk saat menyalin upload ke disk
 API_KEY = os.getenv("API_KEY")  # jika di-set, header x-api-key wajib
+# batas waktu COPY streaming /download/all?format=csv (detik), terpisah dari
+# command_timeout pool karena mencakup waktu menunggu client yang lambat
+EXPORT_TIMEOUT_SECONDS = float(os.getenv("EXPORT_TIMEOUT_SECONDS", "3600"))
+# umur cache kolom tabel (detik); berlaku per worker, jadi setelah DDL semua
+# worker paling lambat memakai struktur baru setelah TTL ini
+COLUMN_CACHE_TTL_SECONDS = float(os.getenv("COLUMN_CACHE_TTL_SECONDS", "60"))
+# direktori kerja sementara (upload & export); default tempfile.gettempdir().
+# Opsional tmpfs, mis. STAGING_ROOT=/dev/shm/gis-uploader (perbesar --shm-size Docker,
+# default 64MB, dan ingat tmpfs dihitung sebagai memori container).
+STAGING_ROOT = os.getenv("STAGING_ROOT")
+# ruang kosong minimal di STAGING_ROOT, dalam kelipatan MAX_UPLOAD_BYTES
+# (zip upload + hasil ekstrak + export yang berjalan bersamaan)
+STAGING_MIN_FREE_FACTOR = 4
+# batas proses ogr2ogr yang berjalan bersamaan (import + export)
+MAX_CONCURRENT_OGR = int(os.getenv("MAX_CONCURRENT_OGR", str(max(2, (os.cpu_count() or 1) // 2))))
+
+# -------------------------
+# Identifier SQL: validasi & quote sekali saat start
+# -------------------------
+_IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+@functools.lru_cache(maxsize=256)
+def quote_table_name(table_fullname: str) -> str:
+    """
+    Validasi 'schema.table' lalu kembalikan bentuk ter-quote '"schema"."table"'.
+    """
+    parts = table_fullname.split(".")
+    if len(parts) != 2 or not all(_IDENT_RE.fullmatch(p) for p in parts):
+        raise RuntimeError(f"Nama tabel tidak valid: {table_fullname!r} (gunakan format schema.table)")
+    return ".".join(quote_ident(p) for p in parts)
+
+TARGET_IDENT = quote_table_name(TARGET_TABLE)
+quote_table_name(STAGING_TABLE)
+STAGING_SUFFIX_HEX = 12
+if len(STAGING_TABLE.split(".")[1]) + 1 + STAGING_SUFFIX_HEX > 63:
+    raise RuntimeError("Nama STAGING_TABLE terlalu panjang (maks. 50 karakter untuk bagian tabel).")
+SELECT_ALL_SQL = f"SELECT * FROM {TARGET_IDENT}"
 
 # -------------------------
 # Setup aplikasi
@@ -33,6 +90,92 @@ app = FastAPI(title="GIS Uploader - Tapak Proyek")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("gis_uploader")
 
+# -------------------------
+# Helper: direktori kerja sementara
+# -------------------------
+def _resolve_staging_root(path: Optional[str]) -> str:
+    """
+    Pakai path (jika di-set) bila bisa ditulis dan ruang kosongnya minimal
+    STAGING_MIN_FREE_FACTOR * MAX_UPLOAD_BYTES, selain itu fallback ke
+    tempfile.gettempdir().
+    """
+    if not path:
+        return tempfile.gettempdir()
+    try:
+        os.makedirs(path, exist_ok=True)
+        if not os.access(path, os.W_OK | os.X_OK):
+            logger.warning("STAGING_ROOT %s tidak bisa ditulis", path)
+        else:
+            free = shutil.disk_usage(path).free
+            if free >= STAGING_MIN_FREE_FACTOR * MAX_UPLOAD_BYTES:
+                return path
+            logger.warning("STAGING_ROOT %s hanya punya %d byte kosong, butuh %d",
+                           path, free, STAGING_MIN_FREE_FACTOR * MAX_UPLOAD_BYTES)
+    except OSError as e:
+        logger.warning("STAGING_ROOT %s tidak bisa dipakai: %s", path, e)
+    return tempfile.gettempdir()
+
+def _raise_if_no_space(e: OSError):
+    if e.errno == errno.ENOSPC:
+        raise HTTPException(status_code=507, detail="Ruang penyimpanan sementara server penuh.")
+
+# -------------------------
+# Lifecycle: connection pool
+# -------------------------
+def _pool_server_settings() -> Dict[str, str]:
+    settings = {"application_name": "gis-uploader"}
+    if DB_JIT_OFF:
+        # query kecil (katalog, DROP staging) tidak perlu keputusan JIT
+        settings["jit"] = "off"
+    return settings
+
+@app.on_event("startup")
+async def startup():
+    app.state.staging_root = _resolve_staging_root(STAGING_ROOT)
+    logger.info("Direktori kerja sementara: %s", app.state.staging_root)
+    app.state.ogr_sem = asyncio.Semaphore(MAX_CONCURRENT_OGR)
+    app.state.pool = await asyncpg.create_pool(
+        DB_DSN,
+        min_size=2,
+        max_size=10,
+        command_timeout=60,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        server_settings=_pool_server_settings(),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.pool.close()
+
+# -------------------------
+# Middleware: tolak upload besar berdasarkan Content-Length
+# -------------------------
+# toleransi untuk boundary & header multipart di luar isi file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+class RejectOversizeUpload:
+    """
+    Middleware ASGI murni: POST /upload dengan Content-Length melebihi batas
+    langsung dijawab 413 sebelum body multipart diparse FastAPI (body tidak dibaca).
+    Request lain diteruskan tanpa dibungkus.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/upload":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+                        response = JSONResponse({"detail": "File terlalu besar."}, status_code=413)
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+app.add_middleware(RejectOversizeUpload)
+
 # -------------------------
 # Dependency: API key sederhana
 # -------------------------
@@ -44,17 +187,43 @@ def require_api_key(x_api_key: Optional[str] = Header(None)):
 # -------------------------
 # Helper: menjalankan ogr2ogr untuk import ke staging
 # -------------------------
+OGR_STDERR_MAX_BYTES = 16 * 1024  # head & tail stderr ogr2ogr yang disimpan untuk log/error
+
+def _run_ogr2ogr(cmd: List[str]) -> Tuple[int, str]:
+    """
+    Jalankan ogr2ogr dan simpan OGR_STDERR_MAX_BYTES pertama serta terakhir dari
+    stderr; bagian tengah dibuang (tetap dibaca sampai habis agar pipe tidak penuh).
+    Tail penting karena ogr2ogr menulis 'Warning' per fitur dulu dan 'ERROR' fatal
+    di akhir. Mengembalikan (returncode, stderr).
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    tail = b""
+    dropped = 0
+    with proc.stderr:
+        head = proc.stderr.read(OGR_STDERR_MAX_BYTES)
+        while chunk := proc.stderr.read(64 * 1024):
+            tail += chunk
+            if len(tail) > OGR_STDERR_MAX_BYTES:
+                dropped += len(tail) - OGR_STDERR_MAX_BYTES
+                tail = tail[-OGR_STDERR_MAX_BYTES:]
+    returncode = proc.wait()
+    if dropped:
+        head += f"\n[... {dropped} byte stderr dilewati ...]\n".encode()
+    return returncode, (head + tail).decode("utf-8", errors="replace")
+
 def ogr2ogr_import(shp_dir: str, staging_table: str):
     """
     Menemukan file .shp di shp_dir lalu menjalankan ogr2ogr untuk memasukkannya
     ke PostGIS sebagai staging_table (overwrite).
     Memaksa reprojeksi ke EPSG:4326 dan geometry name 'geom'.
+    Staging dibuat tanpa spatial index (hanya dibaca sekali untuk append
+    lalu di-drop).
     """
-    shp_file = None
-    for f in os.listdir(shp_dir):
-        if f.lower().endswith(".shp"):
-            shp_file = os.path.join(shp_dir, f)
-            break
+    with os.scandir(shp_dir) as it:
+        shp_file = next(
+            (e.path for e in it if e.name.lower().endswith(".shp") and e.is_file(follow_symlinks=False)),
+            None
+        )
     if not shp_file:
         raise RuntimeError("Tidak ditemukan file .shp di dalam zip.")
 
@@ -67,21 +236,82 @@ def ogr2ogr_import(shp_dir: str, staging_table: str):
         "-overwrite",
         "-lco", "GEOMETRY_NAME=geom",
         "-lco", "ENCODING=UTF-8",
+        "-lco", "SPATIAL_INDEX=NONE",
         "-t_srs", "EPSG:4326"
     ]
     logger.info("Menjalankan ogr2ogr import: %s", " ".join(cmd))
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    if proc.returncode != 0:
-        logger.error("ogr2ogr error: %s", proc.stderr)
-        raise RuntimeError(f"ogr2ogr gagal: {proc.stderr}")
+    returncode, stderr = _run_ogr2ogr(cmd)
+    if returncode != 0:
+        logger.error("ogr2ogr error: %s", stderr)
+        raise RuntimeError(f"ogr2ogr gagal: {stderr}")
+
+# -------------------------
+# Helper: salin upload yang sudah di-spool ke disk
+# -------------------------
+def _sendfile_copy(src_fd: int, dst_path: str, size: int):
+    """
+    Salin size byte dari src_fd (mulai offset 0) ke dst_path dengan os.sendfile,
+    data tetap di kernel tanpa buffer bytes di Python.
+    """
+    with open(dst_path, "wb") as dst:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+# -------------------------
+# Helper: ekstrak hanya file shapefile dari zip
+# -------------------------
+SHAPEFILE_EXTS = {"shp", "shx", "dbf", "prj", "cpg"}
+
+def extract_shapefile_members(zip_path: str, dest_dir: str):
+    """
+    Ekstrak hanya member .shp/.shx/.dbf/.prj/.cpg dari zip_path ke dest_dir (flat).
+    Member lain (__MACOSX/, thumbnail, dll) dilewati tanpa didekompresi.
+    Zip harus berisi tepat satu shapefile: nama file ganda (mis. a/x.dbf dan
+    b/x.dbf) atau lebih dari satu .shp ditolak dengan 400.
+    """
+    seen = set()
+    shp_count = 0
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for info in z.infolist():
+            # hanya basename yang dipakai: path di dalam zip (termasuk ../) dibuang,
+            # jadi file tidak bisa ditulis di luar dest_dir (penjaga zip-slip)
+            name = os.path.basename(info.filename)
+            if not name or info.filename.startswith("__MACOSX/"):
+                continue
+            ext = name.lower().rsplit(".", 1)[-1]
+            if ext not in SHAPEFILE_EXTS:
+                continue
+            if name.lower() in seen:
+                raise HTTPException(status_code=400, detail=f"Nama file ganda di dalam ZIP: {name}")
+            seen.add(name.lower())
+            if ext == "shp":
+                shp_count += 1
+                if shp_count > 1:
+                    raise HTTPException(status_code=400, detail="ZIP berisi lebih dari satu file .shp.")
+            with z.open(info) as src, open(os.path.join(dest_dir, name), "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1024 * 1024)
 
 # -------------------------
 # Helper DB: kolom tabel
 # -------------------------
-async def get_table_columns(conn: asyncpg.Connection, table_fullname: str) -> List[str]:
+# cache in-process: 'schema.table' -> (waktu fetch, list kolom). Kolom hanya berubah
+# saat DDL; entry kedaluwarsa setelah COLUMN_CACHE_TTL_SECONDS (tiap worker uvicorn
+# punya cache sendiri) dan dibuang lebih awal jika append ke target gagal.
+_col_cache: Dict[str, Tuple[float, List[str]]] = {}
+
+async def get_table_columns(conn: asyncpg.Connection, table_fullname: str, use_cache: bool = True) -> List[str]:
     """
     Kembalikan list nama kolom untuk table_fullname dalam format 'schema.table'
+    (di-cache per proses kecuali use_cache=False).
     """
+    if use_cache:
+        cached = _col_cache.get(table_fullname)
+        if cached is not None and time.monotonic() - cached[0] < COLUMN_CACHE_TTL_SECONDS:
+            return cached[1]
     if "." not in table_fullname:
         raise ValueError("Table name harus berformat schema.table")
     schema, table = table_fullname.split(".", 1)
@@ -94,7 +324,10 @@ async def get_table_columns(conn: asyncpg.Connection, table_fullname: str) -> Li
         """,
         schema, table
     )
-    return [r["column_name"] for r in rows]
+    cols = [r["column_name"] for r in rows]
+    if use_cache:
+        _col_cache[table_fullname] = (time.monotonic(), cols)
+    return cols
 
 # -------------------------
 # Helper: append dari staging ke target
@@ -105,8 +338,9 @@ async def append_from_staging(conn: asyncpg.Connection, target_table: str, stagi
     Untuk kolom target yang tidak ada di staging akan diisi NULL.
     Mengembalikan jumlah baris yang di-insert.
     """
+    # kolom target di-cache; kolom staging bisa berubah per upload -> selalu query
     target_cols = await get_table_columns(conn, target_table)
-    staging_cols = await get_table_columns(conn, staging_table)
+    staging_cols = await get_table_columns(conn, staging_table, use_cache=False)
 
     # create mapping staging lowercase -> original name
     staging_map = {c.lower(): c for c in staging_cols}
@@ -116,19 +350,22 @@ async def append_from_staging(conn: asyncpg.Connection, target_table: str, stagi
     for col in target_cols:
         if col == "id":  # skip primary serial
             continue
-        insert_cols.append(col)
+        insert_cols.append(quote_ident(col))
         if col.lower() in staging_map:
             # gunakan nama kolom staging asli, lalu alias ke nama target
-            select_exprs.append(f"{staging_map[col.lower()]} AS {col}")
+            select_exprs.append(f"{quote_ident(staging_map[col.lower()])} AS {quote_ident(col)}")
         else:
-            select_exprs.append(f"NULL AS {col}")
+            select_exprs.append(f"NULL AS {quote_ident(col)}")
 
     if not insert_cols:
         raise RuntimeError("Tidak ada kolom untuk di-insert ke tabel target.")
 
     insert_cols_sql = ", ".join(insert_cols)
     select_sql = ", ".join(select_exprs)
-    sql = f"INSERT INTO {target_table} ({insert_cols_sql}) SELECT {select_sql} FROM {staging_table};"
+    sql = (
+        f"INSERT INTO {quote_table_name(target_table)} ({insert_cols_sql}) "
+        f"SELECT {select_sql} FROM {quote_table_name(staging_table)};"
+    )
     logger.info("Menjalankan append SQL ke target")
     res = await conn.execute(sql)
     # asyncpg execute mengembalikan 'INSERT 0 X' -> ambil angka terakhir
@@ -156,36 +393,73 @@ async def upload_shp(file: UploadFile = File(...)):
     if not file.filename.lower().endswith(".zip"):
         raise HTTPException(status_code=400, detail="Unggah file .zip yang berisi shapefile (.shp .dbf .shx .prj).")
 
-    contents = await file.read()
-    if len(contents) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=413, detail="File terlalu besar.")
-
-    tmp_dir = tempfile.mkdtemp(prefix="upload_")
-    zip_path = os.path.join(tmp_dir, file.filename)
-    with open(zip_path, "wb") as f:
-        f.write(contents)
-
+    tmp_dir = tempfile.mkdtemp(prefix="upload_", dir=app.state.staging_root)
+    zip_path = os.path.join(tmp_dir, os.path.basename(file.filename))
+    src = file.file
     try:
-        with zipfile.ZipFile(zip_path, "r") as z:
-            z.extractall(tmp_dir)
-    except Exception as e:
+        if getattr(src, "_rolled", False) and hasattr(os, "sendfile"):
+            # upload sudah di-spool ke tempfile: cek ukuran lalu salin di kernel (sendfile)
+            size = os.fstat(src.fileno()).st_size
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="File terlalu besar.")
+            await asyncio.to_thread(_sendfile_copy, src.fileno(), zip_path, size)
+        else:
+            # salin per chunk ke disk, tanpa menampung seluruh isi file di memori
+            total = 0
+            with open(zip_path, "wb") as f:
+                while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                    total += len(chunk)
+                    if total > MAX_UPLOAD_BYTES:
+                        raise HTTPException(status_code=413, detail="File terlalu besar.")
+                    f.write(chunk)
+    except BaseException as e:
         shutil.rmtree(tmp_dir, ignore_errors=True)
-        raise HTTPException(status_code=400, detail=f"Gagal mengekstrak ZIP: {e}")
+        if isinstance(e, OSError):
+            _raise_if_no_space(e)
+        raise
 
-    # import to staging (blocking) via thread
     try:
-        await asyncio.to_thread(ogr2ogr_import, tmp_dir, STAGING_TABLE)
+        extract_shapefile_members(zip_path, tmp_dir)
+    except HTTPException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
     except Exception as e:
         shutil.rmtree(tmp_dir, ignore_errors=True)
-        raise HTTPException(status_code=500, detail=f"Import shapefile gagal: {e}")
+        if isinstance(e, OSError):
+            _raise_if_no_space(e)
+        raise HTTPException(status_code=400, detail=f"Gagal mengekstrak ZIP: {e}")
 
-    conn = await asyncpg.connect(DB_DSN)
+    # staging khusus upload ini, jadi upload lain (worker lain) tidak bisa menimpanya
+    staging_table = f"{STAGING_TABLE}_{uuid.uuid4().hex[:STAGING_SUFFIX_HEX]}"
+    drop_staging_sql = f"DROP TABLE IF EXISTS {quote_table_name(staging_table)};"
     try:
-        inserted = await append_from_staging(conn, TARGET_TABLE, STAGING_TABLE)
-        # kosongkan staging table (tetap biarkan strukturnya jika perlu)
-        await conn.execute(f"TRUNCATE TABLE {STAGING_TABLE};")
+        # import to staging (blocking) via thread
+        try:
+            async with app.state.ogr_sem:
+                await asyncio.to_thread(ogr2ogr_import, tmp_dir, staging_table)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Import shapefile gagal: {e}")
+
+        try:
+            async with app.state.pool.acquire() as conn:
+                # append + drop staging dalam satu transaksi: satu commit, dan jika append
+                # gagal di tengah jalan target otomatis di-rollback
+                async with conn.transaction():
+                    inserted = await append_from_staging(conn, TARGET_TABLE, staging_table)
+                    await conn.execute(drop_staging_sql)
+        except (asyncpg.PostgresError, RuntimeError) as e:
+            # bisa karena struktur target berubah (DDL): ambil ulang kolom di upload berikutnya
+            _col_cache.pop(TARGET_TABLE, None)
+            raise HTTPException(status_code=500, detail=f"Append ke tabel target gagal (di-rollback): {e}")
+    except BaseException:
+        # import/append gagal: buang staging yang mungkin sudah (sebagian) dibuat
+        try:
+            async with app.state.pool.acquire() as conn:
+                await conn.execute(drop_staging_sql)
+        except Exception as e:
+            logger.warning("Gagal menghapus staging %s: %s", staging_table, e)
+        raise
     finally:
-        await conn.close()
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return JSONResponse({"status": "ok", "inserted_rows": inserted})
@@ -209,70 +483,210 @@ def _run_ogr2ogr_export(sql: str, out_dir: str, layer_name: str = "export_tapak"
         "-t_srs", "EPSG:4326"
     ]
     logger.info("Menjalankan ogr2ogr export: %s", " ".join(cmd))
-    proc = subprocess.run(cmd, capture_output=True, text=True)
-    if proc.returncode != 0:
-        logger.error("ogr2ogr export failed: %s", proc.stderr)
-        raise RuntimeError(f"ogr2ogr export gagal: {proc.stderr}")
+    returncode, stderr = _run_ogr2ogr(cmd)
+    if returncode != 0:
+        logger.error("ogr2ogr export failed: %s", stderr)
+        raise RuntimeError(f"ogr2ogr export gagal: {stderr}")
 
 def _zip_shapefile_dir(src_dir: str, zip_out_path: str) -> str:
-    base = zip_out_path.replace(".zip", "")
-    archive = shutil.make_archive(base_name=base, format='zip', root_dir=src_dir)
-    return archive
+    # DEFLATE level 1: jauh lebih hemat CPU dibanding default (6), ukuran zip
+    # hanya sedikit lebih besar untuk data shapefile
+    with zipfile.ZipFile(zip_out_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for root, _, files in os.walk(src_dir):
+            for f in files:
+                p = os.path.join(root, f)
+                zf.write(p, os.path.relpath(p, src_dir))
+    return zip_out_path
+
+# singleflight export: key (sql, zip_name) -> (task export, tmpdir) yang sedang berjalan
+_inflight: Dict[str, Tuple[asyncio.Task, str]] = {}
+# jumlah pemegang per tmpdir export (task export + tiap request); dihapus saat 0
+_export_refs: Dict[str, int] = {}
+
+def _release_export(tmpdir: str):
+    remaining = _export_refs.get(tmpdir, 1) - 1
+    if remaining > 0:
+        _export_refs[tmpdir] = remaining
+        return
+    _export_refs.pop(tmpdir, None)
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+async def _run_export(key: str, sql: str, zip_path: str, tmpdir: str) -> str:
+    # task ini memegang slot semaphore dan satu referensi tmpdir sampai ogr2ogr
+    # benar-benar selesai, walau request yang memulainya sudah dibatalkan
+    try:
+        shp_dir = os.path.join(tmpdir, "shp")
+        os.mkdir(shp_dir)
+        async with app.state.ogr_sem:
+            await asyncio.to_thread(_run_ogr2ogr_export, sql, shp_dir)
+        created = await asyncio.to_thread(_zip_shapefile_dir, shp_dir, zip_path)
+        shutil.rmtree(shp_dir, ignore_errors=True)
+        return created
+    finally:
+        # lepas dari _inflight dulu: request baru tidak boleh menemukan task ini
+        # setelah referensinya dilepas (tmpdir bisa sudah dihapus)
+        if _inflight.get(key, (None,))[0] is asyncio.current_task():
+            _inflight.pop(key)
+        _release_export(tmpdir)
 
 async def _export_sql_to_zip(sql: str, zip_name: str):
-    tmpdir = tempfile.mkdtemp(prefix="export_")
+    """
+    Export hasil sql ke zip shapefile. Request bersamaan dengan (sql, zip_name)
+    yang sama menunggu task export yang sama dan memakai file yang sama.
+    Setiap pemanggil wajib memanggil _release_export(tmpdir) setelah selesai.
+    """
+    key = hashlib.sha1(f"{zip_name}\n{sql}".encode()).hexdigest()
+    inflight = _inflight.get(key)
+    if inflight is None:
+        tmpdir = tempfile.mkdtemp(prefix="export_", dir=app.state.staging_root)
+        zip_path = os.path.join(tmpdir, zip_name)
+        _export_refs[tmpdir] = 1  # referensi milik task export
+        task = asyncio.create_task(_run_export(key, sql, zip_path, tmpdir))
+        inflight = _inflight[key] = (task, tmpdir)
+
+        def _done(t: asyncio.Task):
+            # tandai exception sudah diambil walau semua request sudah batal
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+
+    task, tmpdir = inflight
+    _export_refs[tmpdir] += 1  # referensi milik request ini
     try:
-        await asyncio.to_thread(_run_ogr2ogr_export, sql, tmpdir)
-        zip_path = os.path.join(tempfile.gettempdir(), zip_name)
-        if os.path.exists(zip_path):
-            try:
-                os.remove(zip_path)
-            except:
-                pass
-        created = await asyncio.to_thread(_zip_shapefile_dir, tmpdir, zip_path)
-        return tmpdir, created
-    except Exception as e:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        zip_path = await asyncio.shield(task)
+    except BaseException:
+        _release_export(tmpdir)
+        raise
+    return tmpdir, zip_path
+
+def _zip_file_response(tmpdir: str, zip_path: str, filename: str, status_code: int, detail: str):
+    if not os.path.exists(zip_path):
+        _release_export(tmpdir)
+        raise HTTPException(status_code=status_code, detail=detail)
+    # gunakan BackgroundTask untuk cleanup setelah response selesai
+    # (async agar refcount hanya diubah di event loop)
+    async def _cleanup():
+        _release_export(tmpdir)
+    return FileResponse(path=zip_path, filename=filename, media_type="application/zip",
+                        background=BackgroundTask(_cleanup))
+
+# -------------------------
+# Helper export: filter id
+# -------------------------
+BIGINT_MIN, BIGINT_MAX = -(2 ** 63), 2 ** 63 - 1
+
+async def _select_existing_ids(id_list: List[int]) -> List[int]:
+    """
+    Cek id yang benar-benar ada di target table lewat query ber-parameter,
+    supaya id yang tidak ada langsung 404 tanpa menjalankan ogr2ogr.
+    Id di luar rentang bigint tidak mungkin ada, jadi dibuang sebelum query.
+    """
+    id_list = [i for i in id_list if BIGINT_MIN <= i <= BIGINT_MAX]
+    if not id_list:
+        return []
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            f"SELECT id FROM {TARGET_IDENT} WHERE id = ANY($1::bigint[]) ORDER BY id",
+            id_list
+        )
+    return [r["id"] for r in rows]
+
+def _sql_by_ids(id_list: List[int]) -> str:
+    # ogr2ogr tidak mendukung bind parameter; id sudah berupa int hasil query di atas
+    id_array = ",".join(str(int(i)) for i in id_list)
+    return f"{SELECT_ALL_SQL} WHERE id = ANY('{{{id_array}}}'::bigint[])"
+
+# -------------------------
+# Helper export: streaming CSV lewat COPY TO STDOUT
+# -------------------------
+async def _start_copy_csv(sql: str):
+    """
+    Jalankan COPY (sql) TO STDOUT dan tunggu chunk pertama sebelum response
+    dibuat: koneksi/pool/SQL yang gagal di awal menjadi HTTPException 500,
+    bukan response 200 yang isinya error.
+    Mengembalikan async generator yang meneruskan chunk ke client begitu
+    diterima dari server (tanpa file sementara). Queue dibatasi supaya client
+    lambat menahan laju COPY (backpressure).
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+
+    async def _produce():
+        try:
+            async with app.state.pool.acquire() as conn:
+                await conn.copy_from_query(sql, output=queue.put, format="csv", header=True,
+                                           timeout=EXPORT_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(None)
+
+    task = asyncio.create_task(_produce())
+    try:
+        first = await queue.get()
+    except BaseException:
+        await _stop_task(task)
         raise
+    if isinstance(first, Exception):
+        logger.error("COPY export gagal: %r", first)
+        raise HTTPException(status_code=500, detail=f"Export CSV gagal: {first}")
+    return _drain_copy_csv(first, queue, task)
+
+async def _drain_copy_csv(first, queue: asyncio.Queue, task: asyncio.Task):
+    """
+    Jika COPY gagal setelah header 200 terkirim, baris penanda "# EXPORT GAGAL"
+    ditulis lalu koneksi diputus tanpa chunk penutup, sehingga client melihat
+    transfer tidak lengkap (bukan CSV yang terpotong diam-diam).
+    """
+    try:
+        item = first
+        while item is not None:
+            if isinstance(item, Exception):
+                logger.error("COPY export gagal: %r", item)
+                yield f"\n# EXPORT GAGAL: {type(item).__name__}\n".encode()
+                raise RuntimeError("COPY export gagal, response dibatalkan") from item
+            yield item
+            item = await queue.get()
+    finally:
+        # client putus di tengah jalan -> hentikan COPY dan kembalikan koneksi
+        await _stop_task(task)
+
+async def _stop_task(task: asyncio.Task):
+    if not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
 
 # -------------------------
 # Endpoint: download all
 # -------------------------
 @app.get("/download/all", dependencies=[Depends(require_api_key)])
-async def download_all():
-    sql = f"SELECT * FROM {TARGET_TABLE}"
+async def download_all(fmt: str = Query("shp", alias="format", description="shp (zip shapefile) atau csv (streaming)")):
+    sql = SELECT_ALL_SQL
+    if fmt == "csv":
+        return StreamingResponse(
+            await _start_copy_csv(sql),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="tapak_proyek_all.csv"'}
+        )
+    if fmt != "shp":
+        raise HTTPException(status_code=400, detail="Format tidak dikenal. Gunakan shp atau csv.")
     tmpdir, zip_path = await _export_sql_to_zip(sql, zip_name="tapak_proyek_all.zip")
-    if not os.path.exists(zip_path):
-        shutil.rmtree(tmpdir, ignore_errors=True)
-        raise HTTPException(status_code=500, detail="Gagal membuat file export.")
-    # gunakan BackgroundTask untuk cleanup setelah response selesai
-    def _cleanup():
-        try:
-            os.remove(zip_path)
-        except:
-            pass
-        shutil.rmtree(tmpdir, ignore_errors=True)
-    return FileResponse(path=zip_path, filename="tapak_proyek_all.zip", media_type="application/zip",
-                        background=BackgroundTask(_cleanup))
+    return _zip_file_response(tmpdir, zip_path, "tapak_proyek_all.zip", 500, "Gagal membuat file export.")
 
 # -------------------------
 # Endpoint: download by id
 # -------------------------
 @app.get("/download/id/{feature_id}", dependencies=[Depends(require_api_key)])
 async def download_by_id(feature_id: int):
-    sql = f"SELECT * FROM {TARGET_TABLE} WHERE id = {feature_id}"
-    tmpdir, zip_path = await _export_sql_to_zip(sql, zip_name=f"tapak_proyek_id_{feature_id}.zip")
-    if not os.path.exists(zip_path):
-        shutil.rmtree(tmpdir, ignore_errors=True)
+    found = await _select_existing_ids([feature_id])
+    if not found:
         raise HTTPException(status_code=404, detail="Fitur tidak ditemukan atau export gagal.")
-    def _cleanup():
-        try:
-            os.remove(zip_path)
-        except:
-            pass
-        shutil.rmtree(tmpdir, ignore_errors=True)
-    return FileResponse(path=zip_path, filename=f"tapak_proyek_id_{feature_id}.zip", media_type="application/zip",
-                        background=BackgroundTask(_cleanup))
+    sql = _sql_by_ids(found)
+    tmpdir, zip_path = await _export_sql_to_zip(sql, zip_name=f"tapak_proyek_id_{feature_id}.zip")
+    return _zip_file_response(tmpdir, zip_path, f"tapak_proyek_id_{feature_id}.zip", 404, "Fitur tidak ditemukan atau export gagal.")
 
 # -------------------------
 # Endpoint: download by ids (comma separated)
@@ -286,16 +700,16 @@ async def download_by_ids(ids: str = Query(..., description="Contoh: ids=1,3,5")
     if not id_list:
         raise HTTPException(status_code=400, detail="Daftar id kosong.")
     id_str = ",".join(str(i) for i in id_list)
-    sql = f"SELECT * FROM {TARGET_TABLE} WHERE id IN ({id_str})"
+    found = await _select_existing_ids(id_list)
+    if not found:
+        raise HTTPException(status_code=404, detail="Fitur tidak ditemukan.")
+    sql = _sql_by_ids(found)
     tmpdir, zip_path = await _export_sql_to_zip(sql, zip_name=f"tapak_proyek_ids_{id_str}.zip")
-    if not os.path.exists(zip_path):
-        shutil.rmtree(tmpdir, ignore_errors=True)
-        raise HTTPException(status_code=404, detail="Export gagal.")
-    def _cleanup():
-        try:
-            os.remove(zip_path)
-        except:
-            pass
-        shutil.rmtree(tmpdir, ignore_errors=True)
-    return FileResponse(path=zip_path, filename=f"tapak_proyek_ids_{id_str}.zip", media_type="application/zip",
-                        background=BackgroundTask(_cleanup))
+    return _zip_file_response(tmpdir, zip_path, f"tapak_proyek_ids_{id_str}.zip", 404, "Export gagal.")
+
+# -------------------------
+# Jalankan langsung: python -m app.main
+# -------------------------
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")